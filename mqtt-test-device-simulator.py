@@ -6,7 +6,9 @@ Comprehensive MQTT Protocol Testing Tool
 Simulates the complete BrainlyTree ESP32-CAM device protocol including:
 - Device status messages (alive with pending counts)
 - Image metadata transmission
-- Chunked image upload with configurable chunk size
+- Chunked image upload with configurable chunk size, streamed chunk-by-chunk
+- Optional raw binary chunk topics (no JSON/base64 envelope), batched per PUBLISH
+- Optional extra publisher connections to spread chunk traffic
 - Missing chunk retry mechanism
 - Offline recovery with pending queue
 - Environmental sensor data (BME680)
@@ -16,32 +18,146 @@ import os
 import json
 import time
 import base64
+import struct
+import threading
+import itertools
 import argparse
 import paho.mqtt.client as mqtt
 import ssl
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Optional
 import random
 
+# orjson encodes straight to bytes in C; fall back to the stdlib when it isn't installed
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# pybase64 encodes with SSSE3/AVX2; same stdlib fallback
+try:
+    import pybase64
+    b64encode = pybase64.b64encode
+except ImportError:
+    b64encode = base64.b64encode
+
 # MQTT Configuration (matches production)
 MQTT_BROKER = "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud"
 MQTT_PORT = 8883
 MQTT_USERNAME = "BrainlyTesting"
 MQTT_PASSWORD = "BrainlyTest@1234"
+MQTT_MAX_INFLIGHT = 100  # paho defaults to 20 unacknowledged QoS>0 messages
+PUBLISH_WINDOW_TIMEOUT = 5  # seconds to wait for the socket to drain before publishing anyway
+
+# Binary batch record header: chunk_id (uint32) + chunk length (uint32), big-endian
+BATCH_RECORD_HEADER = struct.Struct('>II')
+
+# Closes the base64 "payload" string and the chunk JSON object (see _chunk_envelope)
+CHUNK_JSON_SUFFIX = b'"}'
+
+JPEG_SOI = b'\xFF\xD8\xFF\xE0'
+JPEG_EOI = b'\xFF\xD9'
+
+
+class ImageClosedError(Exception):
+    """Raised when reading from an ImageSource that a newer capture has closed"""
+
+
+class ImageSource:
+    """Image read chunk-by-chunk on demand, like the ESP32 streaming from its SD card"""
+
+    def __init__(self, size: int, path: Optional[str] = None):
+        self.size = size
+        self.path = path
+        self._file = open(path, 'rb') if path else None
+        # Resends read from another thread; seek/read and close must not interleave
+        self._file_lock = threading.Lock()
+        self._seed = random.getrandbits(64)
+
+    @classmethod
+    def from_file(cls, path: str) -> "ImageSource":
+        return cls(os.path.getsize(path), path)
+
+    @classmethod
+    def generate(cls) -> "ImageSource":
+        """Mock JPEG-like image; 30-80KB typical for ESP32-CAM"""
+        return cls(random.randint(30000, 80000))
+
+    def total_chunks(self, chunk_size: int) -> int:
+        return (self.size + chunk_size - 1) // chunk_size
+
+    def read_chunk(self, chunk_id: int, chunk_size: int) -> bytes:
+        """Read one chunk; generated images return the same bytes for the same chunk every time"""
+        if not 0 <= chunk_id < self.total_chunks(chunk_size):
+            raise IndexError(f"Chunk {chunk_id} out of range for a {self.size} byte image")
+        offset = chunk_id * chunk_size
+        length = min(chunk_size, self.size - offset)
+
+        if self.path:
+            with self._file_lock:
+                if self._file is None:
+                    raise ImageClosedError(f"Image {self.path} is closed")
+                self._file.seek(offset)
+                return self._file.read(length)
+
+        # Seed per offset so resent chunks match the originals without keeping the image around
+        data = bytearray(random.Random(self._seed + offset).randbytes(length))
+        for marker_offset, marker in ((0, JPEG_SOI), (self.size - len(JPEG_EOI), JPEG_EOI)):
+            lo = max(offset, marker_offset)
+            hi = min(offset + length, marker_offset + len(marker))
+            if lo < hi:
+                data[lo - offset:hi - offset] = marker[lo - marker_offset:hi - marker_offset]
+        return bytes(data)
+
+    @property
+    def closed(self) -> bool:
+        return self.path is not None and self._file is None
+
+    def close(self):
+        with self._file_lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
 
 class MockESP32Device:
     """Simulates an ESP32-CAM device with complete protocol implementation"""
 
-    def __init__(self, device_mac: str, test_mode: str = "normal"):
+    def __init__(self, device_mac: str, test_mode: str = "normal", binary_chunks: bool = False,
+                 batch_chunks: int = 16, publisher_count: int = 1):
         self.device_mac = device_mac
+        # Stable client id so the broker can resume the persistent session after a reconnect
+        self.client_id = f"esp32-{device_mac}"
         self.test_mode = test_mode
+        self.binary_chunks = binary_chunks
+        self.batch_chunks = batch_chunks
+        self.publisher_count = max(1, publisher_count)
         self.client: Optional[mqtt.Client] = None
+        # Connections that carry chunk traffic; the first is always the main client
+        self.pub_clients: List[mqtt.Client] = []
+        self._publishers = None
         self.connected = False
         self.pending_images = []
         self.current_image_name = None
+        self.current_image: Optional[ImageSource] = None
+        self.current_chunk_size = 8192
         self.awaiting_ack = False
         self.missing_chunks_requested = []
+        # Set once a resend ran for the current image; unlike the list above, ACK_OK keeps it
+        self.missing_chunks_retried = False
+
+        # Signalled from the paho network thread so callers can block instead of polling
+        self._connected_evt = threading.Event()
+        self._ack_evt = threading.Event()
+
+        # Data-path backpressure: (client, mid) of chunk publishes not yet handed to the socket
+        self._publish_cond = threading.Condition()
+        self._unpublished = set()
 
         # Simulated sensor data
         self.temperature = 72.5
@@ -51,15 +167,32 @@ class MockESP32Device:
 
         print(f"[DEVICE] Initialized mock device: {device_mac}")
         print(f"[DEVICE] Test mode: {test_mode}")
+        if binary_chunks:
+            print("[DEVICE] Chunk format: raw binary")
+        if self.publisher_count > 1:
+            print(f"[DEVICE] Publisher connections: {self.publisher_count}")
+
+    def _create_client(self, client_id: str, clean_session: bool) -> mqtt.Client:
+        """Create a paho client with the shared credentials, TLS and throughput settings"""
+        client = mqtt.Client(client_id=client_id, clean_session=clean_session,
+                             callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        client.tls_set(cert_reqs=ssl.CERT_NONE)
+        client.tls_insecure_set(True)
+
+        # Widen the in-flight window and leave the outgoing queue unbounded (0)
+        client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+        client.max_queued_messages_set(0)
+
+        client.on_publish = self._on_publish
+        client.on_disconnect = self._on_publisher_disconnect
+        return client
 
     def connect_mqtt(self):
         """Establish MQTT connection with HiveMQ Cloud"""
         print(f"\n[MQTT] Connecting to {MQTT_BROKER}:{MQTT_PORT}...")
 
-        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-        self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-        self.client.tls_set(cert_reqs=ssl.CERT_NONE)
-        self.client.tls_insecure_set(True)
+        self.client = self._create_client(self.client_id, clean_session=False)
 
         # Set up callbacks
         self.client.on_connect = self._on_connect
@@ -71,13 +204,9 @@ class MockESP32Device:
             self.client.loop_start()
 
             # Wait for connection
-            timeout = 10
-            start_time = time.time()
-            while not self.connected and (time.time() - start_time) < timeout:
-                time.sleep(0.1)
-
-            if self.connected:
+            if self._connected_evt.wait(timeout=10):
                 print("[MQTT] ✅ Connected successfully")
+                self._connect_publishers()
                 return True
             else:
                 print("[MQTT] ❌ Connection timeout")
@@ -86,18 +215,56 @@ class MockESP32Device:
             print(f"[MQTT] ❌ Connection failed: {e}")
             return False
 
+    def _connect_publishers(self):
+        """Open the extra publish-only connections; chunks are spread round-robin across them"""
+        self.pub_clients = [self.client]
+
+        for i in range(1, self.publisher_count):
+            connected = threading.Event()
+
+            def on_connect(client, userdata, flags, rc, properties=None, connected=connected):
+                if rc == 0:
+                    connected.set()
+
+            pub = self._create_client(f"{self.client_id}-pub{i}", clean_session=True)
+            pub.on_connect = on_connect
+            try:
+                pub.connect(MQTT_BROKER, MQTT_PORT, 60)
+                pub.loop_start()
+            except Exception as e:
+                print(f"[MQTT] ⚠️  Publisher {i} failed to connect: {e}")
+                continue
+
+            if connected.wait(timeout=10):
+                self.pub_clients.append(pub)
+            else:
+                print(f"[MQTT] ⚠️  Publisher {i} connection timeout")
+                pub.loop_stop()
+                # Don't let a late CONNACK leave an unused connection open
+                pub.disconnect()
+
+        self._publishers = itertools.cycle(self.pub_clients)
+        if len(self.pub_clients) > 1:
+            print(f"[MQTT] ✅ {len(self.pub_clients)} publisher connections ready")
+
     def _on_connect(self, client, userdata, flags, rc, properties=None):
         """MQTT connection callback"""
         if rc == 0:
             self.connected = True
+            self._connected_evt.set()
             print("[MQTT] Connection established")
 
-            # Subscribe to command and ack topics
+            # The broker keeps our subscriptions (and queued QoS 1 messages) in a resumed session
+            if flags.session_present:
+                print("[MQTT] Resumed persistent session")
+                return
+
+            # Subscribe to command and ack topics at QoS 1 so the broker queues them while offline
             cmd_topic = f"device/{self.device_mac}/cmd"
             ack_topic = f"device/{self.device_mac}/ack"
 
-            client.subscribe(cmd_topic)
-            client.subscribe(ack_topic)
+            client.subscribe(cmd_topic, qos=1)
+            client.subscribe(ack_topic, qos=1)
             print(f"[MQTT] Subscribed to {cmd_topic}")
             print(f"[MQTT] Subscribed to {ack_topic}")
         else:
@@ -106,12 +273,41 @@ class MockESP32Device:
     def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties=None):
         """MQTT disconnection callback"""
         self.connected = False
+        self._connected_evt.clear()
+        self._on_publisher_disconnect(client, userdata, disconnect_flags, reason_code, properties)
         print(f"[MQTT] Disconnected with reason code {reason_code}")
 
+    def _on_publisher_disconnect(self, client, userdata, disconnect_flags, reason_code, properties=None):
+        """Drop the connection's unwritten chunks from the window; no on_publish will come for them"""
+        with self._publish_cond:
+            self._unpublished = {key for key in self._unpublished if key[0] is not client}
+            self._publish_cond.notify_all()
+
+    def _on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        """MQTT publish callback; for QoS 0 this fires once the message is written out"""
+        with self._publish_cond:
+            # Metadata and status publishes are not part of the window
+            if (client, mid) in self._unpublished:
+                self._unpublished.discard((client, mid))
+                self._publish_cond.notify()
+
+    def _publish_data(self, topic: str, payload):
+        """Publish on the data path, waiting while MQTT_MAX_INFLIGHT messages are still unwritten"""
+        # Chunks may reach the broker out of order across connections; receivers index by chunk_id
+        client = next(self._publishers)
+        with self._publish_cond:
+            self._publish_cond.wait_for(lambda: len(self._unpublished) < MQTT_MAX_INFLIGHT,
+                                        timeout=PUBLISH_WINDOW_TIMEOUT)
+            # Held across publish() so on_publish can't run before the mid is recorded
+            info = client.publish(topic, payload, qos=0)
+            # A rejected publish gets no on_publish; a fast one may already be written out
+            if info.rc == mqtt.MQTT_ERR_SUCCESS and not info.is_published():
+                self._unpublished.add((client, info.mid))
+
     def _on_message(self, client, userdata, msg):
         """Handle incoming MQTT messages from server"""
         try:
-            payload = json.loads(msg.payload.decode('utf-8'))
+            payload = json_loads(msg.payload)
             topic = msg.topic
 
             print(f"\n[RECV] Message on {topic}")
@@ -140,24 +336,47 @@ class MockESP32Device:
     def _handle_ack(self, payload: Dict):
         """Handle server acknowledgments"""
         if "missing_chunks" in payload:
+            # A request for an earlier image can't be served once the next capture started
+            requested_image = payload.get("image_name")
+            if requested_image and requested_image != self.current_image_name:
+                print(f"[ACK] Ignoring missing chunk request for {requested_image}")
+                return
+
             missing_chunks = payload.get("missing_chunks", [])
             print(f"[ACK] Server requests {len(missing_chunks)} missing chunks: {missing_chunks}")
             self.missing_chunks_requested = missing_chunks
 
-            # Resend missing chunks
-            if self.current_image_name:
+            # Resend missing chunks off the network thread, which has to keep
+            # running on_publish for the publish window to drain. The image is
+            # bound now so a capture starting meanwhile can't swap it out.
+            image = self.current_image
+            if self.current_image_name and image:
                 print(f"[RETRY] Resending missing chunks...")
-                time.sleep(0.5)  # Brief delay
-                self._send_missing_chunks(self.current_image_name, missing_chunks)
+                self.missing_chunks_retried = True
+                threading.Thread(target=self._send_missing_chunks,
+                                 args=(self.current_image_name, image, self.current_chunk_size,
+                                       missing_chunks),
+                                 daemon=True).start()
 
         elif "ACK_OK" in payload:
-            ack_data = payload.get("ACK_OK", {})
-            next_wake = ack_data.get("next_wake_time", "unknown")
+            # Ignore ACKs for other images (e.g. a late ACK for the previous capture)
+            acked_image = payload.get("image_name")
+            if acked_image and acked_image != self.current_image_name:
+                return
+
+            # Batch-drain ACKs send a bare ACK_OK: true without wake info
+            ack_data = payload.get("ACK_OK")
+            next_wake = ack_data.get("next_wake_time", "unknown") if isinstance(ack_data, dict) else "unknown"
             print(f"[ACK] ✅ Image transmission successful!")
             print(f"[ACK] Next wake scheduled: {next_wake}")
             self.awaiting_ack = False
             self.current_image_name = None
             self.missing_chunks_requested = []
+            self._ack_evt.set()
+
+    def wait_for_ack(self, timeout: float) -> bool:
+        """Block until ACK_OK arrives for the current image; returns False on timeout"""
+        return self._ack_evt.wait(timeout)
 
     def send_status_message(self, pending_count: int = 0):
         """Send device status (alive) message"""
@@ -170,66 +389,87 @@ class MockESP32Device:
         }
 
         print(f"\n[STATUS] Sending alive message (pending: {pending_count})")
-        self.client.publish(status_topic, json.dumps(status_msg))
+        self.client.publish(status_topic, json_dumps(status_msg), qos=0)
         print(f"[STATUS] Published to {status_topic}")
 
-    def capture_and_send_image(self, image_path: Optional[str] = None, chunk_size: int = 8192):
+    def prepare_image(self, image_path: Optional[str] = None) -> ImageSource:
+        """Open the test image, or set up mock JPEG data if no usable path is given"""
+        if image_path and os.path.exists(image_path):
+            image = ImageSource.from_file(image_path)
+            print(f"[CAPTURE] Loaded test image: {image.size} bytes")
+        else:
+            image = ImageSource.generate()
+            print(f"[CAPTURE] Generated mock image: {image.size} bytes")
+        return image
+
+    def capture_and_send_image(self, image_path: Optional[str] = None, chunk_size: int = 8192,
+                               batch_chunks: Optional[int] = None, image: Optional[ImageSource] = None,
+                               pending_count: int = 0):
         """
         Simulate image capture and transmission
 
         Args:
             image_path: Path to test image file (if None, generates random data)
             chunk_size: Size of each chunk in bytes (default 8KB, matching ESP32 typical)
+            batch_chunks: Chunks packed per PUBLISH in binary mode (1 disables batching,
+                          None uses the device default)
+            image: Image already produced by prepare_image (skips loading)
+            pending_count: Images queued on the device including this one, as in the status
+                           message (sent in metadata; 0 for a live capture)
         """
-        # Generate image name
+        if batch_chunks is None:
+            batch_chunks = self.batch_chunks
+
+        # Generate image name; the capture instant is taken once and reused in metadata
         timestamp = int(time.time() * 1000)
+        capture_timestamp = datetime.utcnow().isoformat() + "Z"
         image_name = f"image_{timestamp}.jpg"
         self.current_image_name = image_name
 
+        # Arm the ACK wait before publishing so a fast ACK_OK can't be missed
+        self._ack_evt.clear()
+        self.awaiting_ack = True
+        self.missing_chunks_retried = False
+
         print(f"\n[CAPTURE] Simulating image capture: {image_name}")
 
-        # Load or generate image data
-        if image_path and os.path.exists(image_path):
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-            print(f"[CAPTURE] Loaded test image: {len(image_data)} bytes")
-        else:
-            # Generate random JPEG-like data (starts with JPEG magic bytes)
-            image_size = random.randint(30000, 80000)  # 30-80KB typical for ESP32-CAM
-            image_data = b'\xFF\xD8\xFF\xE0' + os.urandom(image_size - 4) + b'\xFF\xD9'
-            print(f"[CAPTURE] Generated mock image: {len(image_data)} bytes")
+        # Load or generate image data; chunks are read from it as they are sent
+        if image is None:
+            image = self.prepare_image(image_path)
+        if self.current_image:
+            self.current_image.close()
+        self.current_image = image
+        self.current_chunk_size = chunk_size
 
         # Add some random variation to sensor data
         self.temperature += random.uniform(-2, 2)
         self.humidity += random.uniform(-3, 3)
         self.pressure += random.uniform(-1, 1)
 
-        # Send metadata first
-        self._send_metadata(image_name, image_data, chunk_size)
-
-        # Brief delay before chunks
-        time.sleep(0.3)
+        # Send metadata first; MQTT keeps publish order on a single client
+        self._send_metadata(image_name, image, chunk_size, capture_timestamp, pending_count)
 
         # Send chunks
-        self._send_chunks(image_name, image_data, chunk_size)
-
-        self.awaiting_ack = True
+        self._send_chunks(image_name, image, chunk_size, batch_chunks)
 
-    def _send_metadata(self, image_name: str, image_data: bytes, chunk_size: int):
-        """Send image metadata message"""
+    def _send_metadata(self, image_name: str, image: ImageSource, chunk_size: int,
+                       capture_timestamp: str, pending_count: int = 0):
+        """Send image metadata message, carrying the device status alongside it"""
         data_topic = f"ESP32CAM/{self.device_mac}/data"
 
-        total_chunks = (len(image_data) + chunk_size - 1) // chunk_size
+        total_chunks = image.total_chunks(chunk_size)
 
         metadata = {
             "device_id": self.device_mac,
-            "capture_timestamp": datetime.utcnow().isoformat() + "Z",
+            "capture_timestamp": capture_timestamp,
             "image_name": image_name,
-            "image_size": len(image_data),
+            "image_size": image.size,
             "max_chunk_size": chunk_size,
             "total_chunks_count": total_chunks,
             "location": "Test Location",
             "error": 0,
+            "status": "alive",
+            "pendingImg": pending_count,
             "temperature": round(self.temperature, 1),
             "humidity": round(self.humidity, 1),
             "pressure": round(self.pressure, 2),
@@ -238,20 +478,28 @@ class MockESP32Device:
 
         print(f"[METADATA] Sending metadata:")
         print(f"  - Image: {image_name}")
-        print(f"  - Size: {len(image_data)} bytes")
+        print(f"  - Size: {image.size} bytes")
         print(f"  - Chunks: {total_chunks}")
         print(f"  - Chunk size: {chunk_size} bytes")
+        print(f"  - Pending (incl. this): {pending_count}")
         print(f"  - Temp: {metadata['temperature']}°F, Humidity: {metadata['humidity']}%")
 
-        self.client.publish(data_topic, json.dumps(metadata))
+        self.client.publish(data_topic, json_dumps(metadata), qos=0)
 
-    def _send_chunks(self, image_name: str, image_data: bytes, chunk_size: int):
-        """Send image chunks"""
+    def _send_chunks(self, image_name: str, image: ImageSource, chunk_size: int, batch_chunks: int = 1):
+        """Send image chunks, reading each one from the image as it goes"""
         data_topic = f"ESP32CAM/{self.device_mac}/data"
 
-        total_chunks = (len(image_data) + chunk_size - 1) // chunk_size
+        total_chunks = image.total_chunks(chunk_size)
+        envelope = self._chunk_envelope(image_name, chunk_size)
+        use_batches = self.binary_chunks and batch_chunks > 1
+        batch = bytearray()
+        batch_count = 0
 
-        print(f"\n[CHUNKS] Sending {total_chunks} chunks...")
+        if use_batches:
+            print(f"\n[CHUNKS] Sending {total_chunks} chunks in batches of {batch_chunks}...")
+        else:
+            print(f"\n[CHUNKS] Sending {total_chunks} chunks...")
 
         for chunk_id in range(total_chunks):
             # Simulate missing chunks in test mode
@@ -259,55 +507,70 @@ class MockESP32Device:
                 print(f"[CHUNKS] ⚠️  Simulating missing chunk {chunk_id + 1}/{total_chunks}")
                 continue
 
-            start = chunk_id * chunk_size
-            end = min(start + chunk_size, len(image_data))
-            chunk_data = image_data[start:end]
-
-            chunk_msg = {
-                "device_id": self.device_mac,
-                "image_name": image_name,
-                "chunk_id": chunk_id,
-                "max_chunk_size": chunk_size,
-                "payload": list(chunk_data)  # Convert bytes to list of ints
-            }
+            chunk_data = image.read_chunk(chunk_id, chunk_size)
 
-            self.client.publish(data_topic, json.dumps(chunk_msg))
+            if use_batches:
+                batch += BATCH_RECORD_HEADER.pack(chunk_id, len(chunk_data))
+                batch += chunk_data
+                batch_count += 1
+                if batch_count == batch_chunks:
+                    self._publish_batch(data_topic, image_name, batch)
+                    batch = bytearray()
+                    batch_count = 0
+            else:
+                self._publish_chunk(data_topic, image_name, chunk_id, chunk_data, envelope)
 
             # Progress indicator
             if (chunk_id + 1) % 5 == 0 or (chunk_id + 1) == total_chunks:
                 print(f"[CHUNKS] Sent {chunk_id + 1}/{total_chunks} chunks ({((chunk_id + 1) / total_chunks * 100):.1f}%)")
 
-            # Small delay between chunks (simulates ESP32 processing)
-            time.sleep(0.05)
+        if batch_count:
+            self._publish_batch(data_topic, image_name, batch)
 
         print(f"[CHUNKS] ✅ All chunks sent")
 
-    def _send_missing_chunks(self, image_name: str, missing_chunk_ids: List[int]):
-        """Resend specific missing chunks"""
-        # For simplicity, we'll regenerate the image data
-        # In real device, this would come from SD card
-        image_size = random.randint(30000, 80000)
-        image_data = b'\xFF\xD8\xFF\xE0' + os.urandom(image_size - 4) + b'\xFF\xD9'
-        chunk_size = 8192
-
+    def _send_missing_chunks(self, image_name: str, image: ImageSource, chunk_size: int,
+                             missing_chunk_ids: List[int]):
+        """Resend specific missing chunks, re-reading them from the image"""
         data_topic = f"ESP32CAM/{self.device_mac}/data"
+        envelope = self._chunk_envelope(image_name, chunk_size)
 
         for chunk_id in missing_chunk_ids:
-            start = chunk_id * chunk_size
-            end = min(start + chunk_size, len(image_data))
-            chunk_data = image_data[start:end]
-
-            chunk_msg = {
-                "device_id": self.device_mac,
-                "image_name": image_name,
-                "chunk_id": chunk_id,
-                "max_chunk_size": chunk_size,
-                "payload": list(chunk_data)
-            }
-
-            self.client.publish(data_topic, json.dumps(chunk_msg))
+            try:
+                chunk_data = image.read_chunk(chunk_id, chunk_size)
+            except IndexError:
+                print(f"[RETRY] Skipping invalid chunk id {chunk_id}")
+                continue
+            except ImageClosedError:
+                print(f"[RETRY] {image_name} was replaced by a new capture; stopping resend")
+                return
+
+            self._publish_chunk(data_topic, image_name, chunk_id, chunk_data, envelope)
             print(f"[RETRY] Resent chunk {chunk_id}")
-            time.sleep(0.05)
+
+    def _chunk_envelope(self, image_name: str, chunk_size: int) -> bytes:
+        """
+        Build the per-image part of a JSON chunk message once, up to the opening
+        quote of the base64 payload, with a %d slot for chunk_id
+        """
+        device_id = json.dumps(self.device_mac).replace('%', '%%')
+        name = json.dumps(image_name).replace('%', '%%')
+        return (f'{{"device_id":{device_id},"image_name":{name},'
+                f'"max_chunk_size":{chunk_size},"chunk_id":%d,"payload":"').encode()
+
+    def _publish_chunk(self, data_topic: str, image_name: str, chunk_id: int,
+                       chunk_data: bytes, envelope: bytes):
+        """Publish a single chunk, either raw on the binary subtopic or JSON-wrapped"""
+        if self.binary_chunks:
+            # Raw bytes; image name and chunk id travel in the topic path
+            self._publish_data(f"{data_topic}/bin/{image_name}/{chunk_id}", chunk_data)
+            return
+
+        self._publish_data(data_topic, envelope % chunk_id + b64encode(chunk_data) + CHUNK_JSON_SUFFIX)
+
+    def _publish_batch(self, data_topic: str, image_name: str, batch: bytearray):
+        """Publish length-prefixed chunk records as one message on the batch subtopic"""
+        self._publish_data(f"{data_topic}/batch/{image_name}", batch)
 
     def simulate_offline_recovery(self, offline_image_count: int = 3):
         """Simulate device that was offline and has pending images"""
@@ -319,40 +582,47 @@ class MockESP32Device:
         # Wait for server to process
         time.sleep(2)
 
-        # Send each pending image
-        for i in range(offline_image_count):
-            print(f"\n[RECOVERY] Sending pending image {i + 1}/{offline_image_count}")
-            self.capture_and_send_image()
+        # Send each pending image, preparing the next one while the current ACK is outstanding
+        with ThreadPoolExecutor(max_workers=1) as prep:
+            next_image = prep.submit(self.prepare_image)
 
-            # Wait for ACK before next
-            timeout = 30
-            start_time = time.time()
-            while self.awaiting_ack and (time.time() - start_time) < timeout:
-                time.sleep(0.5)
+            for i in range(offline_image_count):
+                print(f"\n[RECOVERY] Sending pending image {i + 1}/{offline_image_count}")
+                self.capture_and_send_image(image=next_image.result(),
+                                            pending_count=offline_image_count - i)
 
-            if self.awaiting_ack:
-                print(f"[RECOVERY] ⚠️  Timeout waiting for ACK on image {i + 1}")
-                break
+                if i + 1 < offline_image_count:
+                    next_image = prep.submit(self.prepare_image)
 
-            print(f"[RECOVERY] ✅ Image {i + 1} acknowledged")
-            time.sleep(1)
+                # Wait for ACK before next
+                if not self.wait_for_ack(timeout=30):
+                    print(f"[RECOVERY] ⚠️  Timeout waiting for ACK on image {i + 1}")
+                    break
+
+                print(f"[RECOVERY] ✅ Image {i + 1} acknowledged")
 
     def disconnect(self):
         """Clean disconnect from MQTT"""
         if self.client:
             print("\n[MQTT] Disconnecting...")
+            for pub in self.pub_clients[1:]:
+                pub.loop_stop()
+                pub.disconnect()
             self.client.loop_stop()
             self.client.disconnect()
             print("[MQTT] Disconnected")
+        if self.current_image:
+            self.current_image.close()
+            self.current_image = None
 
 
-def test_normal_operation(device_mac: str):
+def test_normal_operation(device_mac: str, **device_opts):
     """Test Case 1: Normal operation with complete image transmission"""
     print("\n" + "="*70)
     print("TEST CASE 1: Normal Operation")
     print("="*70)
 
-    device = MockESP32Device(device_mac, test_mode="normal")
+    device = MockESP32Device(device_mac, test_mode="normal", **device_opts)
 
     if not device.connect_mqtt():
         print("❌ Failed to connect")
@@ -367,12 +637,7 @@ def test_normal_operation(device_mac: str):
         device.capture_and_send_image()
 
         # Wait for ACK
-        timeout = 30
-        start_time = time.time()
-        while device.awaiting_ack and (time.time() - start_time) < timeout:
-            time.sleep(0.5)
-
-        if not device.awaiting_ack:
+        if device.wait_for_ack(timeout=30):
             print("\n✅ TEST PASSED: Normal operation successful")
             return True
         else:
@@ -382,13 +647,13 @@ def test_normal_operation(device_mac: str):
         device.disconnect()
 
 
-def test_missing_chunks(device_mac: str):
+def test_missing_chunks(device_mac: str, **device_opts):
     """Test Case 2: Missing chunks with retry mechanism"""
     print("\n" + "="*70)
     print("TEST CASE 2: Missing Chunks Retry")
     print("="*70)
 
-    device = MockESP32Device(device_mac, test_mode="missing_chunks")
+    device = MockESP32Device(device_mac, test_mode="missing_chunks", **device_opts)
 
     if not device.connect_mqtt():
         print("❌ Failed to connect")
@@ -403,12 +668,7 @@ def test_missing_chunks(device_mac: str):
         device.capture_and_send_image()
 
         # Wait for missing chunk request and ACK
-        timeout = 45
-        start_time = time.time()
-        while device.awaiting_ack and (time.time() - start_time) < timeout:
-            time.sleep(0.5)
-
-        if not device.awaiting_ack and len(device.missing_chunks_requested) > 0:
+        if device.wait_for_ack(timeout=45) and device.missing_chunks_retried:
             print("\n✅ TEST PASSED: Missing chunks detected and retried")
             return True
         else:
@@ -418,13 +678,13 @@ def test_missing_chunks(device_mac: str):
         device.disconnect()
 
 
-def test_offline_recovery(device_mac: str):
+def test_offline_recovery(device_mac: str, **device_opts):
     """Test Case 3: Offline recovery with pending images"""
     print("\n" + "="*70)
     print("TEST CASE 3: Offline Recovery")
     print("="*70)
 
-    device = MockESP32Device(device_mac, test_mode="normal")
+    device = MockESP32Device(device_mac, test_mode="normal", **device_opts)
 
     if not device.connect_mqtt():
         print("❌ Failed to connect")
@@ -449,6 +709,16 @@ def main():
     parser.add_argument("--test", choices=["normal", "missing_chunks", "offline_recovery", "all"],
                        default="all", help="Test scenario to run")
     parser.add_argument("--image", help="Path to test image file (optional)")
+    parser.add_argument("--binary-chunks", action="store_true",
+                       help="Publish chunks as raw bytes on ESP32CAM/<mac>/data/bin/<image>/<chunk_id>")
+    parser.add_argument("--batch-chunks", type=int, default=16,
+                       help="Chunks per batched PUBLISH on ESP32CAM/<mac>/data/batch/<image> "
+                            "when --binary-chunks is set (1 disables batching)")
+    parser.add_argument("--publishers", type=int, default=1,
+                       help="MQTT connections used to publish chunks (chunks are spread across them)")
+    parser.add_argument("--parallel", action="store_true",
+                       help="Run the selected scenarios concurrently, one MQTT client each "
+                            "(each scenario uses its own device MAC, <mac>-<scenario>)")
 
     args = parser.parse_args()
 
@@ -459,6 +729,8 @@ def main():
     print(f"MQTT Broker: {MQTT_BROKER}:{MQTT_PORT}")
     print("="*70)
 
+    device_opts = {"binary_chunks": args.binary_chunks, "batch_chunks": args.batch_chunks,
+                   "publisher_count": args.publishers}
     results = {}
 
     if args.test == "all":
@@ -466,15 +738,23 @@ def main():
     else:
         tests = [args.test]
 
-    for test in tests:
-        time.sleep(2)  # Delay between tests
-
-        if test == "normal":
-            results["normal"] = test_normal_operation(args.mac)
-        elif test == "missing_chunks":
-            results["missing_chunks"] = test_missing_chunks(args.mac)
-        elif test == "offline_recovery":
-            results["offline_recovery"] = test_offline_recovery(args.mac)
+    scenarios = {
+        "normal": test_normal_operation,
+        "missing_chunks": test_missing_chunks,
+        "offline_recovery": test_offline_recovery,
+    }
+
+    if args.parallel:
+        with ThreadPoolExecutor(max_workers=len(tests)) as pool:
+            # Distinct MACs keep topics, client ids and server-side device state apart
+            futures = {test: pool.submit(scenarios[test], f"{args.mac}-{test}", **device_opts)
+                       for test in tests}
+            for test, future in futures.items():
+                results[test] = future.result()
+    else:
+        # Each scenario waits for its own ACK, so no settling delay is needed between them
+        for test in tests:
+            results[test] = scenarios[test](args.mac, **device_opts)
 
     # Print summary
     print("\n" + "="*70)
@@ -1,104 +1,263 @@
-import os
 import json
 import paho.mqtt.client as mqtt
-from collections import defaultdict
 import ssl
 import time
 import base64
+import struct
+import queue
+import threading
+from pathlib import Path
+
+# orjson parses bytes directly in C; fall back to the stdlib when it isn't installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# pybase64 decodes with SSSE3/AVX2; same stdlib fallback
+try:
+    import pybase64
+    b64decode = pybase64.b64decode
+except ImportError:
+    b64decode = base64.b64decode
 
 # ========== Configuration ==========
 MQTT_BROKER = "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud"  # Or your HiveMQ instance
 MQTT_PORT = 8883
 MQTT_TOPIC = "ESP32CAM/B8F862F9CFB8/data"  #B8F862F9ECF8
+MQTT_BIN_TOPIC = f"{MQTT_TOPIC}/bin/#"  # Raw chunks: .../data/bin/<image_name>/<chunk_id>
+MQTT_BATCH_TOPIC = f"{MQTT_TOPIC}/batch/#"  # Batched raw chunks: .../data/batch/<image_name>
+BATCH_RECORD_HEADER = struct.Struct('>II')  # chunk_id (uint32) + chunk length (uint32)
 MQTT_USERNAME = "BrainlyTesting"
 MQTT_PASSWORD = "BrainlyTest@1234"
+DEFAULT_CHUNK_SIZE = 8192  # Used when metadata doesn't carry max_chunk_size
+MISSING_CHUNK_TIMEOUT = 15  # Seconds without a new chunk before asking the device for the gaps
+MAX_MISSING_CHUNK_REQUESTS = 3  # Give up on an image after this many unanswered requests
+IMAGES_DIR = Path("images")
+
+# Ensure the images directory exists once, rather than checking on every save
+IMAGES_DIR.mkdir(exist_ok=True)
 
 chunks = {}
 image_name = None
 max_chunks = None
 
-# Store image chunks
-image_chunks = defaultdict(lambda: {
-    'max_chunks': None,
-    'chunks': {},
-    'received_count': 0
-})
+
+# Reassembles one image in a flat buffer sized from its metadata
+class ImageAssembler:
+    __slots__ = ('max_chunks', 'chunk_size', 'buf', 'received_mask', 'full_mask', 'size',
+                 'updated_at', 'missing_requests')
+
+    def __init__(self, max_chunks, chunk_size, image_size=None):
+        self.max_chunks = max_chunks
+        self.chunk_size = chunk_size
+        # Exact size when metadata carries a plausible image_size, else room for every full chunk
+        capacity = max_chunks * chunk_size
+        if image_size and capacity - chunk_size < image_size <= capacity:
+            capacity = image_size
+        self.buf = bytearray(capacity)
+        self.received_mask = 0  # Bit i set once chunk i has been written
+        self.full_mask = (1 << max_chunks) - 1
+        self.size = 0  # End of the furthest chunk written so far
+        self.updated_at = time.monotonic()
+        self.missing_requests = 0
+
+    # Write a chunk in place; returns False for duplicate or out-of-range chunks
+    def add(self, chunk_id, chunk_bytes):
+        # Range-check before shifting; a huge or negative id must not reach 1 << chunk_id
+        if not 0 <= chunk_id < self.max_chunks or len(chunk_bytes) > self.chunk_size:
+            return False
+        start = chunk_id * self.chunk_size
+        end = start + len(chunk_bytes)
+        bit = 1 << chunk_id
+        if end > len(self.buf) or self.received_mask & bit:
+            return False
+
+        self.buf[start:end] = chunk_bytes
+        self.received_mask |= bit
+        self.size = max(self.size, end)
+        self.updated_at = time.monotonic()
+        return True
+
+    def is_complete(self):
+        return self.received_mask == self.full_mask
+
+    # Chunk ids not received yet, lowest first, from the clear bits of the mask
+    def missing_chunks(self):
+        gaps = ~self.received_mask & self.full_mask
+        missing = []
+        while gaps:
+            lowest = gaps & -gaps
+            missing.append(lowest.bit_length() - 1)
+            gaps ^= lowest
+        return missing
+
+
+# Store image chunks: image_key -> ImageAssembler, created when metadata arrives
+image_chunks = {}
+# Chunks that arrived before their image's metadata: image_key -> (first_seen, [(chunk_id, chunk_bytes)])
+# Dropped after MISSING_CHUNK_TIMEOUT if the metadata never shows up
+early_chunks = {}
+
+
+# Completed images waiting to be written: (file_path, buffer, size)
+write_queue = queue.Queue()
+
+
+# Writes completed images off the MQTT callback thread so disk I/O doesn't stall message handling
+def image_writer():
+    while True:
+        file_path, buf, size = write_queue.get()
+        try:
+            # Save the assembled buffer straight to the file; the memoryview slice avoids copying it
+            with open(file_path, "wb") as f, memoryview(buf) as view:
+                f.write(view[:size])
+            print(f"[✅] Image saved as: {file_path}")
+        except OSError as e:
+            print(f"[⚠️] Failed to save {file_path}: {e}")
+        finally:
+            write_queue.task_done()
+
+
+threading.Thread(target=image_writer, daemon=True).start()
 
 
 # Function to save image with a unique name
 def save_image(image_key, image_name):
-    chunks = image_chunks[image_key]['chunks']
-    merged_bytes = b''.join(chunks[i] for i in sorted(chunks))
+    # Clear memory; the writer thread holds the buffer until it's on disk
+    assembler = image_chunks.pop(image_key)
 
     # Create a unique filename (e.g., use a timestamp or any unique identifier)
     unique_image_name = f"{int(time.time() * 1000)}_{image_name}"  # Prefix with current timestamp to make it unique
-    file_path = os.path.join("images", unique_image_name)
+    file_path = IMAGES_DIR / unique_image_name
+
+    write_queue.put((file_path, assembler.buf, assembler.size))
 
-    # Ensure the "images" directory exists
-    if not os.path.exists("images"):
-        os.makedirs("images")
+# Store a decoded chunk and save the image once every chunk is in
+def store_chunk(device_id, image_name, chunk_id, chunk_bytes):
+    image_key = f"{device_id}|{image_name}"
 
-    # Save the merged image to the file
-    with open(file_path, "wb") as f:
-        f.write(merged_bytes)
-    print(f"[✅] Image saved as: {file_path}")
+    assembler = image_chunks.get(image_key)
+    if assembler is None:
+        # No metadata yet; keep the chunk until we know the image layout
+        early_chunks.setdefault(image_key, (time.monotonic(), []))[1].append((chunk_id, chunk_bytes))
+        print(f"[📦] Received chunk {chunk_id + 1}/? for {image_name} (waiting for metadata)")
+        return
 
-    # Clear memory
-    del image_chunks[image_key]
+    if not assembler.add(chunk_id, chunk_bytes):
+        print(f"[⚠️] Ignoring duplicate or invalid chunk {chunk_id} for {image_name}")
+        return
+
+    print(f"[📦] Received chunk {chunk_id + 1}/{assembler.max_chunks} for {image_name}")
+
+    if assembler.is_complete():
+        print(f"[✅] All chunks received for {image_name}. Saving image...")
+        save_image(image_key, image_name)
+
+# Ask devices to resend chunks for images that have stalled and drop early chunks whose
+# metadata never came; run periodically from the main loop
+def request_missing_chunks(client):
+    now = time.monotonic()
+    for image_key, (first_seen, chunks) in list(early_chunks.items()):
+        if now - first_seen >= MISSING_CHUNK_TIMEOUT:
+            print(f"[❌] No metadata for {image_key.split('|', 1)[1]}; dropping {len(chunks)} early chunks")
+            early_chunks.pop(image_key, None)
+
+    for image_key, assembler in list(image_chunks.items()):
+        if now - assembler.updated_at < MISSING_CHUNK_TIMEOUT:
+            continue
+
+        device_id, image_name = image_key.split('|', 1)
+        if assembler.missing_requests >= MAX_MISSING_CHUNK_REQUESTS:
+            print(f"[❌] Giving up on {image_name}: still missing {assembler.missing_chunks()}")
+            image_chunks.pop(image_key, None)
+            continue
+
+        missing = assembler.missing_chunks()
+        client.publish(f"ESP32CAM/{device_id}/ack", json.dumps({
+            'device_id': device_id,
+            'image_name': image_name,
+            'missing_chunks': missing
+        }))
+        assembler.missing_requests += 1
+        assembler.updated_at = now
+        print(f"[🔁] Requested {len(missing)} missing chunks for {image_name}: {missing}")
 
 # ======= Callbacks =======
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         print("[✔] Connected to MQTT Broker!")
         client.subscribe(MQTT_TOPIC)
+        client.subscribe(MQTT_BIN_TOPIC)
+        client.subscribe(MQTT_BATCH_TOPIC)
         print(f"[🔔] Subscribed to topic: {MQTT_TOPIC}")
+        print(f"[🔔] Subscribed to topic: {MQTT_BIN_TOPIC}")
+        print(f"[🔔] Subscribed to topic: {MQTT_BATCH_TOPIC}")
     else:
         print(f"[❌] Failed to connect, return code {rc}")
 
 # Callback for receiving messages (image chunks)
 def on_message(client, userdata, msg):
     try:
-        payload_str = msg.payload.decode('utf-8')
-        payload = json.loads(payload_str)
+        # Raw binary chunk: ESP32CAM/<device_id>/data/bin/<image_name>/<chunk_id>
+        if '/data/bin/' in msg.topic:
+            parts = msg.topic.split('/')
+            store_chunk(parts[1], parts[-2], int(parts[-1]), msg.payload)
+            return
+
+        # Batched raw chunks: ESP32CAM/<device_id>/data/batch/<image_name>
+        # Payload is a sequence of [chunk_id:uint32][length:uint32][bytes] records
+        if '/data/batch/' in msg.topic:
+            parts = msg.topic.split('/')
+            batch = memoryview(msg.payload)
+            # Walk every record first so a truncated batch stores nothing
+            records = []
+            offset = 0
+            while offset < len(batch):
+                if offset + BATCH_RECORD_HEADER.size > len(batch):
+                    print(f"[⚠️] Truncated batch for {parts[-1]}: partial record header, dropping batch")
+                    return
+                chunk_id, length = BATCH_RECORD_HEADER.unpack_from(batch, offset)
+                offset += BATCH_RECORD_HEADER.size
+                if offset + length > len(batch):
+                    print(f"[⚠️] Truncated batch for {parts[-1]}: chunk {chunk_id} is short, dropping batch")
+                    return
+                records.append((chunk_id, batch[offset:offset + length]))
+                offset += length
+
+            for chunk_id, chunk_bytes in records:
+                store_chunk(parts[1], parts[-1], chunk_id, chunk_bytes)
+            return
+
+        payload = json_loads(msg.payload)
 
         device_id = payload.get('device_id')
         image_name = payload.get('image_name')
 
-        # Detect if this is metadata message (has total_chunk_count but no chunk_id)
-        if 'total_chunk_count' in payload and 'chunk_id' not in payload:
-            total_chunks = payload['total_chunk_count']
-            # Store total_chunks info for this image_key
+        total_chunks = payload.get('total_chunk_count') or payload.get('total_chunks_count')
+
+        # Detect if this is metadata message (has total chunk count but no chunk_id)
+        if total_chunks and 'chunk_id' not in payload:
+            chunk_size = payload.get('max_chunks_size') or payload.get('max_chunk_size') or DEFAULT_CHUNK_SIZE
             image_key = f"{device_id}|{image_name}"
-            # Initialize or update the dict for this image
-            if image_key not in image_chunks:
-                image_chunks[image_key] = {
-                    'max_chunks': total_chunks,
-                    'chunks': {},
-                    'received_count': 0
-                }
-            else:
-                image_chunks[image_key]['max_chunks'] = total_chunks
+            # Allocate the buffer for this image; keep it if repeated metadata describes the same layout
+            existing = image_chunks.get(image_key)
+            if existing is None or (existing.max_chunks, existing.chunk_size) != (total_chunks, chunk_size):
+                image_chunks[image_key] = ImageAssembler(total_chunks, chunk_size, payload.get('image_size'))
 
             print(f"[ℹ️] Metadata received for {image_name} with total chunks: {total_chunks}")
+            if 'pendingImg' in payload:
+                print(f"[ℹ️] {device_id} has {payload['pendingImg']} pending images, including this one")
+
+            for chunk_id, chunk_bytes in early_chunks.pop(image_key, (None, []))[1]:
+                store_chunk(device_id, image_name, chunk_id, chunk_bytes)
 
         # Else, this is a chunk message
         elif 'chunk_id' in payload:
             chunk_id = payload['chunk_id']
-            chunk_bytes = base64.b64decode(payload['payload'])
-
-            image_key = f"{device_id}|{image_name}"
-
-            data = image_chunks[image_key]
-            max_chunks = data['max_chunks']
-
-            data['chunks'][chunk_id] = chunk_bytes
-            data['received_count'] = len(data['chunks'])
-
-            print(f"[📦] Received chunk {chunk_id + 1}/{max_chunks} for {image_name}")
-
-            if data['received_count'] == max_chunks:
-                print(f"[✅] All chunks received for {image_name}. Saving image...")
-                save_image(image_key, image_name)
+            chunk_bytes = b64decode(payload['payload'], validate=False)
+            store_chunk(device_id, image_name, chunk_id, chunk_bytes)
         else:
             print("[⚠️] Unknown message format received")
 
@@ -118,5 +277,19 @@ client.on_message = on_message
 print("[🚀] Connecting to MQTT broker...")
 client.connect(MQTT_BROKER, MQTT_PORT, 60)
 
-# Blocking loop
-client.loop_forever()
\ No newline at end of file
+# Network loop and the stalled-image sweep share the main thread, so on_message
+# and request_missing_chunks never touch image_chunks concurrently
+try:
+    while True:
+        if client.loop(timeout=1.0) != mqtt.MQTT_ERR_SUCCESS:
+            # loop() doesn't reconnect on its own the way loop_forever() did
+            time.sleep(1)
+            try:
+                client.reconnect()
+            except OSError as e:
+                print(f"[⚠️] Reconnect failed: {e}")
+        request_missing_chunks(client)
+except KeyboardInterrupt:
+    client.disconnect()
+    # Let queued images finish writing before exit
+    write_queue.join()
\ No newline at end of file